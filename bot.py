@@ -1,11 +1,17 @@
 import os
 import json
 import asyncio
+import heapq
+import importlib.util
 import logging
-from datetime import datetime, timedelta
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime
 from telegram import Update
 from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler
 from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -22,24 +28,87 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 TOPIC_ID = int(os.getenv("TOPIC_ID", "0"))
 MESSAGE_COOLDOWN_HOURS = int(os.getenv("MESSAGE_COOLDOWN_HOURS", "24"))
+MESSAGE_COOLDOWN_SECONDS = MESSAGE_COOLDOWN_HOURS * 3600
 WARNING_DELETE_SECONDS = int(os.getenv("WARNING_DELETE_SECONDS", "10"))
 ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))  # 5 minutes default
 
+# Webhook mode: Telegram pushes updates to WEBHOOK_URL instead of the bot polling for them
+USE_WEBHOOK = os.getenv("USE_WEBHOOK", "false").lower() in ("1", "true", "yes")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public base URL, e.g. https://bot.example.com
+PORT = int(os.getenv("PORT", "8443"))
+
+# Delay before writing changed state to disk (coalesces bursts into one write)
+FLUSH_DELAY = 1.0
+
+# How often expired records are pruned from memory (seconds)
+RECORDS_CLEANUP_INTERVAL = 600
+
+# Size limits for in-memory caches and how often stale entries are swept (seconds)
+ADMIN_CACHE_MAX_CHATS = 1000
+RECENT_WARNINGS_MAX = 10_000
+CACHE_SWEEP_INTERVAL = 60
+
+# A user is warned at most once per this many seconds (until the previous warning is gone)
+WARNING_REPEAT_SECONDS = WARNING_DELETE_SECONDS + 2
+
+# Warning sent when a user posts again before their cooldown ends
+WARNING_TMPL = (
+    "⚠️ @{username}, you can only send 1 message per {cooldown} hours.\n"
+    "Please wait {hours}h {minutes}m before sending another message."
+)
+
 # Allowed groups - comma-separated list of group IDs (empty = allow all)
 ALLOWED_GROUPS_STR = os.getenv("ALLOWED_GROUPS", "")
-ALLOWED_GROUPS = [int(g.strip()) for g in ALLOWED_GROUPS_STR.split(",") if g.strip()]
+ALLOWED_GROUPS = frozenset(int(g.strip()) for g in ALLOWED_GROUPS_STR.split(",") if g.strip())
 
 # Telegram's anonymous admin bot ID
 # When a user posts anonymously as the group, Telegram uses this bot ID
 # See: https://core.telegram.org/bots/api#user (is_bot field)
 GROUP_ANONYMOUS_BOT_ID = 1087968824
 
-# Data file to persist message records (use /app/data in Docker)
+# Data files (use /app/data in Docker)
 DATA_DIR = os.getenv("DATA_DIR", ".")
+DB_FILE = os.path.join(DATA_DIR, "topic_limiter.db")
+
+# JSON files used by older versions; imported into DB_FILE on first start
 DATA_FILE = os.path.join(DATA_DIR, "message_records.json")
 CUSTOM_ADMINS_FILE = os.path.join(DATA_DIR, "custom_admins.json")
 USER_COOLDOWNS_FILE = os.path.join(DATA_DIR, "user_cooldowns.json")
 
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    user_id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS custom_admins (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS cooldowns (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    hours INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+"""
+
+# Statements used to write pending changes, per table: (upsert, delete)
+DB_WRITES = {
+    "records": (
+        "INSERT OR REPLACE INTO records (user_id, ts) VALUES (?, ?)",
+        "DELETE FROM records WHERE user_id = ?",
+    ),
+    "custom_admins": (
+        "INSERT OR IGNORE INTO custom_admins (chat_id, user_id) VALUES (?, ?)",
+        "DELETE FROM custom_admins WHERE chat_id = ? AND user_id = ?",
+    ),
+    "cooldowns": (
+        "INSERT OR REPLACE INTO cooldowns (chat_id, user_id, hours) VALUES (?, ?, ?)",
+        "DELETE FROM cooldowns WHERE chat_id = ? AND user_id = ?",
+    ),
+}
+
 def ensure_data_dir():
     """Ensure the data directory exists."""
     if DATA_DIR and DATA_DIR != "." and not os.path.exists(DATA_DIR):
@@ -47,195 +116,429 @@ def ensure_data_dir():
         logger.info(f"Created data directory: {DATA_DIR}")
 
 def ensure_data_file(file_path: str):
-    """Ensure the data file exists and is valid (not a directory)."""
+    """Ensure the data directory exists and the data file path is not a directory."""
     ensure_data_dir()
     
     # Check if file is accidentally a directory (Docker mount issue)
     if os.path.isdir(file_path):
         logger.warning(f"{file_path} is a directory! This can happen if Docker mounted a non-existent file.")
-        logger.warning(f"Removing directory and creating file...")
+        logger.warning(f"Removing directory so the file can be created...")
         import shutil
         shutil.rmtree(file_path)
-    
-    # Create empty JSON file if it doesn't exist
-    if not os.path.exists(file_path):
-        with open(file_path, 'w') as f:
-            json.dump({}, f)
-        logger.info(f"Created data file: {file_path}")
 
-def load_records():
-    """Load message records from file."""
-    ensure_data_file(DATA_FILE)
-    try:
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError) as e:
-        logger.error(f"Error loading records: {e}. Starting with empty records.")
-        return {}
-
-def save_records(records):
-    """Save message records to file."""
-    ensure_data_file(DATA_FILE)
-    with open(DATA_FILE, 'w') as f:
-        json.dump(records, f, indent=2)
-
-def load_custom_admins():
-    """Load custom admins from file. Returns dict keyed by chat_id."""
-    ensure_data_file(CUSTOM_ADMINS_FILE)
-    try:
-        with open(CUSTOM_ADMINS_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError) as e:
-        logger.error(f"Error loading custom admins: {e}. Starting with empty list.")
-        return {}
-
-def save_custom_admins(admins: dict):
-    """Save custom admins to file."""
-    ensure_data_file(CUSTOM_ADMINS_FILE)
-    with open(CUSTOM_ADMINS_FILE, 'w') as f:
-        json.dump(admins, f, indent=2)
-
-def load_user_cooldowns():
-    """Load user cooldowns from file. Returns dict keyed by chat_id, then user_id."""
-    ensure_data_file(USER_COOLDOWNS_FILE)
+_db: sqlite3.Connection | None = None
+
+def get_db() -> sqlite3.Connection:
+    """Open the SQLite database on first use and create the schema."""
+    global _db
+    if _db is None:
+        ensure_data_file(DB_FILE)
+        _db = sqlite3.connect(DB_FILE, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(DB_SCHEMA)
+    return _db
+
+def close_db():
+    """Close the database connection if it is open."""
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
+
+def save_changes(changes: dict[str, tuple[list, list]]):
+    """Apply pending changes in one transaction. Maps table -> (rows to upsert, keys to delete)."""
+    db = get_db()
+    with db:
+        for table, (upserts, deletes) in changes.items():
+            upsert_sql, delete_sql = DB_WRITES[table]
+            db.executemany(upsert_sql, upserts)
+            db.executemany(delete_sql, deletes)
+
+def load_legacy_json(file_path: str):
+    """Load an old JSON data file for migration. Returns None if there is nothing to import."""
+    if not os.path.isfile(file_path):
+        return None
     try:
-        with open(USER_COOLDOWNS_FILE, 'r') as f:
-            return json.load(f)
+        with open(file_path, 'r') as f:
+            return json.load(f) or None
     except (json.JSONDecodeError, IOError) as e:
-        logger.error(f"Error loading user cooldowns: {e}. Starting with empty list.")
-        return {}
-
-def save_user_cooldowns(cooldowns: dict):
-    """Save user cooldowns to file."""
-    ensure_data_file(USER_COOLDOWNS_FILE)
-    with open(USER_COOLDOWNS_FILE, 'w') as f:
-        json.dump(cooldowns, f, indent=2)
-
-def clean_old_records(records: dict, chat_id: int) -> dict:
-    """Remove records older than the cooldown period. Considers custom cooldowns."""
-    now = datetime.now()
+        logger.error(f"Error loading {file_path}: {e}. Skipping migration.")
+        return None
+
+def migrate_legacy_json(file_path: str, table: str, rows: list):
+    """Import rows from an old JSON data file and rename it so it is only imported once."""
+    save_changes({table: (rows, [])})
+    os.replace(file_path, f"{file_path}.migrated")
+    logger.info(f"Migrated {len(rows)} rows from {file_path} to {DB_FILE}")
+
+def load_records() -> dict[int, float]:
+    """Load message records (user_id -> epoch seconds) from the database."""
+    records = dict(get_db().execute("SELECT user_id, ts FROM records"))
+    
+    data = None if records else load_legacy_json(DATA_FILE)
+    if data:
+        for user_id, timestamp in data.items():
+            # Very old versions stored ISO timestamp strings
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp).timestamp()
+            records[int(user_id)] = timestamp
+        migrate_legacy_json(DATA_FILE, "records", list(records.items()))
+    return records
+
+def load_custom_admins() -> dict[int, set[int]]:
+    """Load custom admins from the database. Returns dict keyed by chat_id, with a set of user IDs per chat."""
+    rows = get_db().execute("SELECT chat_id, user_id FROM custom_admins").fetchall()
+    
+    data = None if rows else load_legacy_json(CUSTOM_ADMINS_FILE)
+    if data:
+        rows = [(int(chat_id), user_id) for chat_id, user_ids in data.items() for user_id in user_ids]
+        migrate_legacy_json(CUSTOM_ADMINS_FILE, "custom_admins", rows)
+    
+    admins = {}
+    for chat_id, user_id in rows:
+        admins.setdefault(chat_id, set()).add(user_id)
+    return admins
+
+def load_user_cooldowns() -> dict[int, dict[int, int]]:
+    """Load user cooldowns from the database. Returns dict keyed by chat_id, then user_id."""
+    rows = get_db().execute("SELECT chat_id, user_id, hours FROM cooldowns").fetchall()
+    
+    data = None if rows else load_legacy_json(USER_COOLDOWNS_FILE)
+    if data:
+        rows = [
+            (int(chat_id), int(user_id), hours)
+            for chat_id, chat_cooldowns in data.items()
+            for user_id, hours in chat_cooldowns.items()
+        ]
+        migrate_legacy_json(USER_COOLDOWNS_FILE, "cooldowns", rows)
+    
+    cooldowns = {}
+    for chat_id, user_id, hours in rows:
+        cooldowns.setdefault(chat_id, {})[user_id] = hours
+    return cooldowns
+
+def clean_old_records(bot_data: dict, chat_id: int) -> dict:
+    """Return the records still within their cooldown period in a chat. Considers custom cooldowns."""
+    now = time.time()
     cleaned = {}
-    user_cooldowns = load_user_cooldowns()
-    chat_cooldowns = user_cooldowns.get(str(chat_id), {})
+    records = bot_data["records"]
+    user_cooldowns = bot_data["user_cooldowns"]
+    chat_cooldown_seconds = {
+        user_id: hours * 3600 for user_id, hours in user_cooldowns.get(chat_id, {}).items()
+    }
     
-    for user_id, timestamp_str in records.items():
-        timestamp = datetime.fromisoformat(timestamp_str)
+    for user_id, timestamp in records.items():
         # Get custom cooldown for this user, or use default
-        user_cooldown_hours = chat_cooldowns.get(user_id, MESSAGE_COOLDOWN_HOURS)
-        if now - timestamp < timedelta(hours=user_cooldown_hours):
-            cleaned[user_id] = timestamp_str
+        if now - timestamp < chat_cooldown_seconds.get(user_id, MESSAGE_COOLDOWN_SECONDS):
+            cleaned[user_id] = timestamp
     return cleaned
 
-def get_user_cooldown_hours(chat_id: int, user_id: int) -> int:
+def get_user_cooldown_hours(bot_data: dict, chat_id: int, user_id: int) -> int:
     """Get the cooldown hours for a specific user (green card support)."""
-    user_cooldowns = load_user_cooldowns()
-    chat_cooldowns = user_cooldowns.get(str(chat_id), {})
-    return chat_cooldowns.get(str(user_id), MESSAGE_COOLDOWN_HOURS)
+    chat_cooldowns = bot_data["user_cooldowns"].get(chat_id, {})
+    return chat_cooldowns.get(user_id, MESSAGE_COOLDOWN_HOURS)
 
-def can_user_send_message(user_id: int, records: dict, chat_id: int) -> tuple[bool, timedelta | None]:
-    """Check if user can send a message. Returns (can_send, time_remaining)."""
-    user_id_str = str(user_id)
-    if user_id_str not in records:
-        return True, None
-    
+def cooldown_remaining(now: float, last_timestamp: float | None, cooldown_hours: int) -> float:
+    """Seconds until a user may post again, or 0.0 if they may post now. Pure arithmetic, no state."""
+    # No previous message, or green card (0 hours cooldown means unlimited messages)
+    if last_timestamp is None or cooldown_hours == 0:
+        return 0.0
+    return max(0.0, cooldown_hours * 3600.0 - (now - last_timestamp))
+
+def can_user_send_message(bot_data: dict, user_id: int, chat_id: int, now: float) -> tuple[bool, float | None, int]:
+    """Check if user can send a message at epoch time `now`. Returns (can_send, seconds_remaining, cooldown_hours)."""
     # Get custom cooldown for this user
-    cooldown_hours = get_user_cooldown_hours(chat_id, user_id)
+    cooldown_hours = get_user_cooldown_hours(bot_data, chat_id, user_id)
     
-    # Green card: 0 hours cooldown means unlimited messages
-    if cooldown_hours == 0:
-        return True, None
+    remaining = cooldown_remaining(now, bot_data["records"].get(user_id), cooldown_hours)
+    if remaining > 0:
+        return False, remaining, cooldown_hours
+    return True, None, cooldown_hours
+
+async def init_bot_data(bot_data: dict):
+    """Load persisted state in a worker thread and set up the runtime state shared by handlers.
+    
+    - records: user_id -> epoch seconds of their last message
+    - custom_admins: chat_id -> set of custom admin user IDs
+    - user_cooldowns: chat_id -> {user_id: cooldown hours}
+    - dirty: table -> keys changed since the last flush (see DB_WRITES)
+    - flush_needed: event that wakes the flush loop
+    - admin_cache: chat_id -> {'admin_ids', 'timestamp' (monotonic)}, oldest entries first
+    - admin_locks: per-chat locks so only one coroutine refreshes an expired admin list at a time
+    - recent_warnings: (chat_id, user_id) -> monotonic time of the last warning, oldest first
+    - pending_deletions: heap of (monotonic deadline, chat_id, message_id) for warnings to delete
+    - deletions_changed: event that wakes the deletion loop when a warning is scheduled
+    - background_tasks: loops started in post_init and cancelled in post_shutdown
+    """
+    def load_all():
+        return load_records(), load_custom_admins(), load_user_cooldowns()
+    
+    # One thread, since all three share the database connection
+    records, custom_admins, user_cooldowns = await asyncio.to_thread(load_all)
+    bot_data.update(
+        records=records,
+        custom_admins=custom_admins,
+        user_cooldowns=user_cooldowns,
+        dirty={table: set() for table in DB_WRITES},
+        flush_needed=asyncio.Event(),
+        admin_cache=OrderedDict(),
+        admin_locks={},
+        recent_warnings=OrderedDict(),
+        pending_deletions=[],
+        deletions_changed=asyncio.Event(),
+        background_tasks=[],
+    )
+
+def mark_dirty(bot_data: dict, table: str, key):
+    """Schedule a changed row to be written to the database.
     
-    last_message_time = datetime.fromisoformat(records[user_id_str])
-    time_since_last = datetime.now() - last_message_time
+    key is the row's primary key: user_id for records, (chat_id, user_id) otherwise.
+    """
+    bot_data["dirty"][table].add(key)
+    bot_data["flush_needed"].set()
+
+def collect_changes(bot_data: dict, dirty: dict[str, set]) -> dict[str, tuple[list, list]]:
+    """Turn dirty keys into (rows to upsert, keys to delete) per table from the current in-memory state."""
+    records = bot_data["records"]
+    custom_admins = bot_data["custom_admins"]
+    user_cooldowns = bot_data["user_cooldowns"]
+    changes = {table: ([], []) for table in dirty}
+    
+    for user_id in dirty["records"]:
+        if user_id in records:
+            changes["records"][0].append((user_id, records[user_id]))
+        else:
+            changes["records"][1].append((user_id,))
+    
+    for chat_id, user_id in dirty["custom_admins"]:
+        if user_id in custom_admins.get(chat_id, ()):
+            changes["custom_admins"][0].append((chat_id, user_id))
+        else:
+            changes["custom_admins"][1].append((chat_id, user_id))
     
-    if time_since_last >= timedelta(hours=cooldown_hours):
-        return True, None
+    for chat_id, user_id in dirty["cooldowns"]:
+        hours = user_cooldowns.get(chat_id, {}).get(user_id)
+        if hours is not None:
+            changes["cooldowns"][0].append((chat_id, user_id, hours))
+        else:
+            changes["cooldowns"][1].append((chat_id, user_id))
     
-    time_remaining = timedelta(hours=cooldown_hours) - time_since_last
-    return False, time_remaining
+    return changes
 
-def check_duplicate_users_today(records: dict) -> list[str]:
-    """Check for any duplicate user messages within the same day."""
-    today = datetime.now().date()
-    users_today = []
-    duplicates = []
+async def flush_state(bot_data: dict):
+    """Write every pending change to the database from a worker thread."""
+    dirty = bot_data["dirty"]
+    pending = {table: keys.copy() for table, keys in dirty.items()}
+    for keys in dirty.values():
+        keys.clear()
+    
+    def retry_later(error: BaseException):
+        """Put the keys back and wake the flush loop so the write is retried."""
+        logger.error(f"Error saving changes: {error}")
+        for table, keys in pending.items():
+            dirty[table].update(keys)
+        bot_data["flush_needed"].set()
+    
+    save = None
+    try:
+        # Build the rows here so the worker thread never reads state while handlers mutate it
+        changes = collect_changes(bot_data, pending)
+        save = asyncio.ensure_future(asyncio.to_thread(save_changes, changes))
+        # Shielded: cancelling the flush loop must not abandon a write that is still running
+        await asyncio.shield(save)
+    except asyncio.CancelledError:
+        # Shutting down: let the worker thread finish before the database is closed
+        if save is not None:
+            await asyncio.wait([save])
+            if save.exception() is not None:
+                retry_later(save.exception())
+        raise
+    except Exception as e:
+        retry_later(e)
+
+async def _flush_loop(bot_data: dict):
+    """Write changed state in the background, coalescing bursts of changes."""
+    flush_needed = bot_data["flush_needed"]
+    while True:
+        await flush_needed.wait()
+        await asyncio.sleep(FLUSH_DELAY)
+        flush_needed.clear()
+        await flush_state(bot_data)
+
+def admit_message(bot_data: dict, user_id: int, chat_id: int, now: float) -> tuple[bool, float | None, int]:
+    """Check a user's cooldown and record the message if it is allowed.
     
-    for user_id, timestamp_str in records.items():
-        timestamp = datetime.fromisoformat(timestamp_str)
-        if timestamp.date() == today:
-            if user_id in users_today:
-                duplicates.append(user_id)
-            else:
-                users_today.append(user_id)
+    This must stay synchronous: with no await between the check and the write,
+    two concurrent updates from the same user can never both be admitted.
+    """
+    records = bot_data["records"]
+    can_send, seconds_remaining, cooldown_hours = can_user_send_message(bot_data, user_id, chat_id, now)
+    if can_send:
+        records[user_id] = now
+        mark_dirty(bot_data, "records", user_id)
+    return can_send, seconds_remaining, cooldown_hours
+
+def prune_expired_records(bot_data: dict) -> int:
+    """Drop records whose cooldown has passed in every chat. Returns the number removed.
     
-    return duplicates
+    A user's record is kept for the longest cooldown that applies to them in any
+    chat, so a custom cooldown in one group never shortens the limit in another.
+    """
+    now = time.time()
+    longest_seconds = {}
+    for chat_cooldowns in bot_data["user_cooldowns"].values():
+        for user_id, hours in chat_cooldowns.items():
+            longest_seconds[user_id] = max(longest_seconds.get(user_id, MESSAGE_COOLDOWN_SECONDS), hours * 3600)
+    
+    records = bot_data["records"]
+    expired = [
+        user_id for user_id, timestamp in records.items()
+        if now - timestamp >= longest_seconds.get(user_id, MESSAGE_COOLDOWN_SECONDS)
+    ]
+    for user_id in expired:
+        del records[user_id]
+        mark_dirty(bot_data, "records", user_id)
+    return len(expired)
 
-# Cache for admin list (to avoid too many API calls)
-admin_cache = {}
+async def _cleanup_records_loop(bot_data: dict):
+    """Periodically prune expired records so lookups never need a full scan."""
+    while True:
+        await asyncio.sleep(RECORDS_CLEANUP_INTERVAL)
+        removed = prune_expired_records(bot_data)
+        if removed:
+            logger.debug("Pruned %s expired records", removed)
 
-# Track users who recently received a warning (to avoid spam warnings)
-recent_warnings = {}
+def remember(cache: OrderedDict, key, value, max_size: int):
+    """Store a value in a bounded cache, evicting the oldest entries beyond max_size."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
 
-async def delete_message_later(bot, chat_id: int, message_id: int, delay: int):
-    """Delete a message after a delay without blocking."""
-    await asyncio.sleep(delay)
-    try:
-        await bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception as e:
-        logger.debug(f"Could not delete warning message: {e}")
+def sweep_caches(bot_data: dict):
+    """Drop expired warning and admin cache entries so long-running bots don't grow forever."""
+    recent_warnings = bot_data["recent_warnings"]
+    admin_cache = bot_data["admin_cache"]
+    admin_locks = bot_data["admin_locks"]
+    
+    now_mono = time.monotonic()
+    for key in [k for k, t in recent_warnings.items() if now_mono - t >= WARNING_REPEAT_SECONDS]:
+        del recent_warnings[key]
+    
+    for chat_id in [c for c, d in admin_cache.items() if now_mono - d['timestamp'] >= ADMIN_CACHE_TTL]:
+        del admin_cache[chat_id]
+    
+    for chat_id in [c for c, lock in admin_locks.items() if not lock.locked() and c not in admin_cache]:
+        del admin_locks[chat_id]
+
+async def _sweep_caches_loop(bot_data: dict):
+    """Periodically sweep expired entries from the in-memory caches."""
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        sweep_caches(bot_data)
 
-def is_custom_admin(chat_id: int, user_id: int) -> bool:
+def schedule_delete(bot_data: dict, chat_id: int, message_id: int, delay: int):
+    """Queue a message for deletion by _deletion_loop after delay seconds."""
+    heapq.heappush(bot_data["pending_deletions"], (time.monotonic() + delay, chat_id, message_id))
+    bot_data["deletions_changed"].set()
+
+async def _deletion_loop(bot, bot_data: dict):
+    """Delete queued messages as their deadlines pass, using one task for all of them."""
+    pending = bot_data["pending_deletions"]
+    changed = bot_data["deletions_changed"]
+    while True:
+        changed.clear()
+        if not pending:
+            await changed.wait()
+            continue
+        
+        # Sleep until the earliest deadline, or until a new deletion is queued
+        delay = pending[0][0] - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(changed.wait(), delay)
+            except TimeoutError:
+                pass
+            continue
+        
+        _, chat_id, message_id = heapq.heappop(pending)
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logger.debug("Could not delete warning message: %s", e)
+
+def get_cached_admin_ids(admin_cache: dict, chat_id: int, now_mono: float) -> frozenset[int] | None:
+    """Return the cached admin IDs for a chat, or None if missing or expired."""
+    cached_data = admin_cache.get(chat_id)
+    if cached_data and now_mono - cached_data['timestamp'] < ADMIN_CACHE_TTL:
+        return cached_data['admin_ids']
+    return None
+
+def is_custom_admin(bot_data: dict, chat_id: int, user_id: int) -> bool:
     """Check if user is in the custom admin list for this chat."""
-    custom_admins = load_custom_admins()
-    chat_admins = custom_admins.get(str(chat_id), [])
-    return user_id in chat_admins
+    chat_admins = bot_data["custom_admins"].get(chat_id)
+    return chat_admins is not None and user_id in chat_admins
 
-async def is_admin(bot, chat_id: int, user_id: int, sender_chat=None) -> bool:
+async def is_admin(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, sender_chat=None,
+                   now_mono: float | None = None) -> bool:
     """Check if user is an admin in the group. 
     
     Supports:
     - Regular admins via Telegram API
     - Custom admins added via /addadmin
     - Anonymous admins (detected via sender_chat)
+    
+    now_mono is the caller's time.monotonic() reading, reused for the admin cache TTL.
     """
     # Check for anonymous admin (sender_chat matches the group)
     if sender_chat and sender_chat.id == chat_id:
-        logger.debug(f"Anonymous admin detected via sender_chat (chat_id: {chat_id})")
+        logger.debug("Anonymous admin detected via sender_chat (chat_id: %s)", chat_id)
         return True
     
     # Check if this is the GroupAnonymousBot (ID: 1087968824)
     if user_id == GROUP_ANONYMOUS_BOT_ID:
-        logger.debug(f"Anonymous admin detected via GroupAnonymousBot ID")
+        logger.debug("Anonymous admin detected via GroupAnonymousBot ID")
         return True
     
-    # Check custom admin list first
-    if is_custom_admin(chat_id, user_id):
+    # Check cache
+    admin_cache = context.bot_data["admin_cache"]
+    if now_mono is None:
+        now_mono = time.monotonic()
+    admin_ids = get_cached_admin_ids(admin_cache, chat_id, now_mono)
+    if admin_ids is not None and user_id in admin_ids:
         return True
     
-    # Check cache
-    cache_key = f"{chat_id}"
-    now = datetime.now()
+    # Check custom admin list (in memory)
+    if is_custom_admin(context.bot_data, chat_id, user_id):
+        return True
     
-    if cache_key in admin_cache:
-        cached_data = admin_cache[cache_key]
-        if (now - cached_data['timestamp']).total_seconds() < ADMIN_CACHE_TTL:
-            return user_id in cached_data['admin_ids']
+    # A fresh cache entry without this user means they are not an admin
+    if admin_ids is not None:
+        return False
     
-    # Fetch fresh admin list from the group
-    try:
-        admins = await bot.get_chat_administrators(chat_id)
-        admin_ids = [admin.user.id for admin in admins]
+    lock = context.bot_data["admin_locks"].setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        # Another coroutine may have refreshed the cache while we waited
+        admin_ids = get_cached_admin_ids(admin_cache, chat_id, now_mono)
+        if admin_ids is not None:
+            return user_id in admin_ids
         
-        # Update cache
-        admin_cache[cache_key] = {
-            'admin_ids': admin_ids,
-            'timestamp': now
-        }
-        
-        return user_id in admin_ids
-    except Exception as e:
-        logger.error(f"Error fetching admins: {e}")
-        return False
+        # Fetch fresh admin list from the group
+        try:
+            admins = await context.bot.get_chat_administrators(chat_id)
+            admin_ids = frozenset(admin.user.id for admin in admins)
+            
+            # Update cache; the TTL starts once the list has arrived, not before the lock/API wait
+            remember(admin_cache, chat_id, {
+                'admin_ids': admin_ids,
+                'timestamp': time.monotonic()
+            }, ADMIN_CACHE_MAX_CHATS)
+            
+            return user_id in admin_ids
+        except Exception as e:
+            logger.error(f"Error fetching admins: {e}")
+            return False
 
 async def is_group_admin_or_creator(bot, chat_id: int, user_id: int) -> bool:
     """Check if user is a real Telegram group admin or creator (for /addadmin, /removeadmin permissions)."""
@@ -252,29 +555,31 @@ def is_allowed_group(chat_id: int) -> bool:
         return True  # If no groups specified, allow all
     return chat_id in ALLOWED_GROUPS
 
+class TopicFilter(filters.MessageFilter):
+    """Pass only messages posted in the monitored topic."""
+    
+    def filter(self, message) -> bool:
+        return message.message_thread_id == TOPIC_ID
+
+def build_message_filter() -> filters.BaseFilter:
+    """Filter for handle_message: new non-command messages in the topic, in allowed groups only.
+    
+    PTB applies it before dispatching, so other chatter never reaches the handler.
+    """
+    message_filter = filters.UpdateType.MESSAGE & TopicFilter() & ~filters.COMMAND
+    if ALLOWED_GROUPS:
+        message_filter = message_filter & filters.Chat(chat_id=ALLOWED_GROUPS)
+    return message_filter
+
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle incoming messages in the topic."""
+    """Handle incoming messages in the topic (pre-filtered by build_message_filter)."""
     message = update.message
-    
-    if not message:
-        return
-    
-    # Check if it's from the correct group and topic
     chat_id = message.chat_id
-    message_thread_id = message.message_thread_id
-    
-    # Debug logging
-    logger.debug(f"Message from chat: {chat_id}, thread: {message_thread_id}, user: {message.from_user.id}")
     
-    # Only process messages from allowed groups
-    if not is_allowed_group(chat_id):
-        logger.debug(f"Ignoring message from non-allowed group: {chat_id}")
-        return
-    
-    # Only process messages in the specific topic
-    if message_thread_id != TOPIC_ID:
-        return
+    # Debug logging (skip building the message entirely unless DEBUG is enabled)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message from chat: %s, thread: %s, user: %s", chat_id, message.message_thread_id, message.from_user.id)
     
     user = message.from_user
     user_id = user.id
@@ -283,68 +588,65 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Get sender_chat for anonymous admin detection
     sender_chat = message.sender_chat
     
+    # One clock reading per message for the admin cache and warning checks
+    now_mono = time.monotonic()
+    
     # Skip admin messages (including anonymous admins and custom admins)
-    if await is_admin(context.bot, chat_id, user_id, sender_chat):
-        logger.debug(f"Skipping admin message from {username} (ID: {user_id})")
+    if await is_admin(context, chat_id, user_id, sender_chat, now_mono):
+        logger.debug("Skipping admin message from %s (ID: %s)", username, user_id)
         return
     
-    # Load and clean records
-    records = load_records()
-    records = clean_old_records(records, chat_id)
-    
-    # Check if user can send a message (with custom cooldown support)
-    can_send, time_remaining = can_user_send_message(user_id, records, chat_id)
+    # Check if user can send a message (with custom cooldown support) and record it if so.
+    # Expired records are treated as absent here and pruned by _cleanup_records_loop.
+    can_send, seconds_remaining, user_cooldown = admit_message(context.bot_data, user_id, chat_id, time.time())
     
     if not can_send:
         # Delete the message immediately
         try:
             await message.delete()
-            logger.debug(f"Deleted spam message from {username} (ID: {user_id})")
+            logger.debug("Deleted spam message from %s (ID: %s)", username, user_id)
+        except BadRequest as e:
+            # Already deleted (by the user or another admin): nothing left to warn about
+            if "message to delete not found" in str(e).lower():
+                logger.debug("Spam message from %s (ID: %s) was already deleted", username, user_id)
+                return
+            logger.error(f"Error deleting message: {e}")
         except Exception as e:
             logger.error(f"Error deleting message: {e}")
         
         # Check if we recently warned this user (avoid warning spam)
-        user_warning_key = f"{chat_id}:{user_id}"
-        now = datetime.now()
+        user_warning_key = (chat_id, user_id)
         
-        if user_warning_key in recent_warnings:
-            last_warning_time = recent_warnings[user_warning_key]
-            # Only send a new warning if the last one was more than WARNING_DELETE_SECONDS ago
-            if (now - last_warning_time).total_seconds() < WARNING_DELETE_SECONDS + 2:
-                # Skip sending another warning, just delete the message
-                return
+        recent_warnings = context.bot_data["recent_warnings"]
+        last_warning_time = recent_warnings.get(user_warning_key)
+        # Only send a new warning once the last one has been deleted
+        if last_warning_time is not None and now_mono - last_warning_time < WARNING_REPEAT_SECONDS:
+            # Skip sending another warning, just delete the message
+            return
         
         # Record that we're warning this user
-        recent_warnings[user_warning_key] = now
+        remember(recent_warnings, user_warning_key, now_mono, RECENT_WARNINGS_MAX)
         
         try:
             # Calculate remaining time
-            hours = int(time_remaining.total_seconds() // 3600)
-            minutes = int((time_remaining.total_seconds() % 3600) // 60)
-            
-            # Get user's cooldown (might be custom)
-            user_cooldown = get_user_cooldown_hours(chat_id, user_id)
+            hours, rem = divmod(int(seconds_remaining), 3600)
+            minutes = rem // 60
             
             # Send a warning (will be deleted after a few seconds)
             warning = await context.bot.send_message(
                 chat_id=chat_id,
                 message_thread_id=TOPIC_ID,
-                text=f"⚠️ @{username}, you can only send 1 message per {user_cooldown} hours.\n"
-                     f"Please wait {hours}h {minutes}m before sending another message.",
+                text=WARNING_TMPL.format(username=username, cooldown=user_cooldown, hours=hours, minutes=minutes),
             )
             
             # Schedule warning deletion without blocking (non-blocking)
-            asyncio.create_task(delete_message_later(context.bot, chat_id, warning.message_id, WARNING_DELETE_SECONDS))
+            schedule_delete(context.bot_data, chat_id, warning.message_id, WARNING_DELETE_SECONDS)
             
         except Exception as e:
             logger.error(f"Error sending warning: {e}")
         
         return
     
-    # Record this message
-    records[str(user_id)] = datetime.now().isoformat()
-    save_records(records)
-    
     logger.info(f"Message from {username} (ID: {user_id}) recorded")
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -356,53 +658,26 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Check if user is admin in the group
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
+    if not await is_admin(context, message.chat_id, message.from_user.id):
         await message.reply_text("❌ This command is for group admins only.")
         return
     
-    records = load_records()
-    records = clean_old_records(records, message.chat_id)
+    records = clean_old_records(context.bot_data, message.chat_id)
     
     if not records:
         await message.reply_text("📊 No messages recorded in the last 24 hours.")
         return
     
-    status_text = "📊 **Message Records (Last 24 Hours)**\n\n"
-    for user_id, timestamp_str in records.items():
-        timestamp = datetime.fromisoformat(timestamp_str)
-        time_ago = datetime.now() - timestamp
-        hours_ago = int(time_ago.total_seconds() // 3600)
-        minutes_ago = int((time_ago.total_seconds() % 3600) // 60)
-        status_text += f"• User ID `{user_id}`: {hours_ago}h {minutes_ago}m ago\n"
+    lines = ["📊 **Message Records (Last 24 Hours)**", ""]
+    now = time.time()
+    for user_id, timestamp in records.items():
+        hours_ago, rem = divmod(int(now - timestamp), 3600)
+        minutes_ago = rem // 60
+        lines.append(f"• User ID `{user_id}`: {hours_ago}h {minutes_ago}m ago")
     
-    status_text += f"\n**Total: {len(records)} users**"
+    lines += ["", f"**Total: {len(records)} users**"]
     
-    await message.reply_text(status_text, parse_mode="Markdown")
-
-async def check_duplicates_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Check for duplicate user messages today."""
-    message = update.message
-    
-    # Only respond in allowed groups
-    if not is_allowed_group(message.chat_id):
-        return
-    
-    # Check if user is admin in the group
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
-        await message.reply_text("❌ This command is for group admins only.")
-        return
-    
-    records = load_records()
-    duplicates = check_duplicate_users_today(records)
-    
-    if duplicates:
-        await message.reply_text(
-            f"⚠️ **Duplicate Users Found Today:**\n" + 
-            "\n".join([f"• User ID: `{uid}`" for uid in duplicates]),
-            parse_mode="Markdown"
-        )
-    else:
-        await message.reply_text("✅ No duplicate user messages found today.")
+    await message.reply_text("\n".join(lines), parse_mode="Markdown")
 
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset a specific user's cooldown (admin only)."""
@@ -413,7 +688,7 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Check if user is admin in the group
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
+    if not await is_admin(context, message.chat_id, message.from_user.id):
         await message.reply_text("❌ This command is for group admins only.")
         return
     
@@ -423,16 +698,18 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        target_user_id = str(context.args[0])
-        records = load_records()
+        target_user_id = int(context.args[0])
         
+        records = context.bot_data["records"]
         if target_user_id in records:
             del records[target_user_id]
-            save_records(records)
+            mark_dirty(context.bot_data, "records", target_user_id)
             await message.reply_text(f"✅ Reset cooldown for user ID: `{target_user_id}`", parse_mode="Markdown")
         else:
             await message.reply_text(f"ℹ️ User ID `{target_user_id}` not found in records.", parse_mode="Markdown")
     
+    except ValueError:
+        await message.reply_text("❌ Invalid user ID. Please provide a numeric user ID.")
     except Exception as e:
         await message.reply_text(f"❌ Error: {e}")
 
@@ -454,18 +731,18 @@ async def addadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         target_user_id = int(context.args[0])
-        chat_id = str(message.chat_id)
+        chat_id = message.chat_id
         
-        custom_admins = load_custom_admins()
+        custom_admins = context.bot_data["custom_admins"]
         if chat_id not in custom_admins:
-            custom_admins[chat_id] = []
+            custom_admins[chat_id] = set()
         
         if target_user_id in custom_admins[chat_id]:
             await message.reply_text(f"ℹ️ User ID `{target_user_id}` is already a custom admin.", parse_mode="Markdown")
             return
         
-        custom_admins[chat_id].append(target_user_id)
-        save_custom_admins(custom_admins)
+        custom_admins[chat_id].add(target_user_id)
+        mark_dirty(context.bot_data, "custom_admins", (chat_id, target_user_id))
         
         await message.reply_text(f"✅ Added user ID `{target_user_id}` to custom admin list.", parse_mode="Markdown")
         logger.info(f"Added custom admin {target_user_id} in chat {chat_id}")
@@ -493,16 +770,16 @@ async def removeadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         target_user_id = int(context.args[0])
-        chat_id = str(message.chat_id)
+        chat_id = message.chat_id
         
-        custom_admins = load_custom_admins()
+        custom_admins = context.bot_data["custom_admins"]
         
         if chat_id not in custom_admins or target_user_id not in custom_admins[chat_id]:
             await message.reply_text(f"ℹ️ User ID `{target_user_id}` is not a custom admin.", parse_mode="Markdown")
             return
         
-        custom_admins[chat_id].remove(target_user_id)
-        save_custom_admins(custom_admins)
+        custom_admins[chat_id].discard(target_user_id)
+        mark_dirty(context.bot_data, "custom_admins", (chat_id, target_user_id))
         
         await message.reply_text(f"✅ Removed user ID `{target_user_id}` from custom admin list.", parse_mode="Markdown")
         logger.info(f"Removed custom admin {target_user_id} from chat {chat_id}")
@@ -519,13 +796,13 @@ async def listadmins_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not is_allowed_group(message.chat_id):
         return
     
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
+    if not await is_admin(context, message.chat_id, message.from_user.id):
         await message.reply_text("❌ This command is for group admins only.")
         return
     
-    chat_id = str(message.chat_id)
-    custom_admins = load_custom_admins()
-    chat_admins = custom_admins.get(chat_id, [])
+    chat_id = message.chat_id
+    custom_admins = context.bot_data["custom_admins"]
+    chat_admins = sorted(custom_admins.get(chat_id, ()))
     
     if not chat_admins:
         await message.reply_text("📋 No custom admins configured for this chat.")
@@ -544,7 +821,7 @@ async def setcooldown_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not is_allowed_group(message.chat_id):
         return
     
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
+    if not await is_admin(context, message.chat_id, message.from_user.id):
         await message.reply_text("❌ This command is for group admins only.")
         return
     
@@ -561,21 +838,20 @@ async def setcooldown_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         # Validate user ID is numeric
         target_user_id = int(context.args[0])
-        target_user_id_str = str(target_user_id)
         cooldown_hours = int(context.args[1])
         
         if cooldown_hours < 0:
             await message.reply_text("❌ Cooldown hours must be 0 or greater.")
             return
         
-        chat_id = str(message.chat_id)
-        user_cooldowns = load_user_cooldowns()
+        chat_id = message.chat_id
+        user_cooldowns = context.bot_data["user_cooldowns"]
         
         if chat_id not in user_cooldowns:
             user_cooldowns[chat_id] = {}
         
-        user_cooldowns[chat_id][target_user_id_str] = cooldown_hours
-        save_user_cooldowns(user_cooldowns)
+        user_cooldowns[chat_id][target_user_id] = cooldown_hours
+        mark_dirty(context.bot_data, "cooldowns", (chat_id, target_user_id))
         
         if cooldown_hours == 0:
             await message.reply_text(
@@ -602,7 +878,7 @@ async def resetcooldown_command(update: Update, context: ContextTypes.DEFAULT_TY
     if not is_allowed_group(message.chat_id):
         return
     
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
+    if not await is_admin(context, message.chat_id, message.from_user.id):
         await message.reply_text("❌ This command is for group admins only.")
         return
     
@@ -613,14 +889,13 @@ async def resetcooldown_command(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         # Validate user ID is numeric
         target_user_id = int(context.args[0])
-        target_user_id_str = str(target_user_id)
-        chat_id = str(message.chat_id)
+        chat_id = message.chat_id
         
-        user_cooldowns = load_user_cooldowns()
+        user_cooldowns = context.bot_data["user_cooldowns"]
         
-        if chat_id in user_cooldowns and target_user_id_str in user_cooldowns[chat_id]:
-            del user_cooldowns[chat_id][target_user_id_str]
-            save_user_cooldowns(user_cooldowns)
+        if chat_id in user_cooldowns and target_user_id in user_cooldowns[chat_id]:
+            del user_cooldowns[chat_id][target_user_id]
+            mark_dirty(context.bot_data, "cooldowns", (chat_id, target_user_id))
             await message.reply_text(
                 f"✅ Reset cooldown for user ID `{target_user_id}` to default ({MESSAGE_COOLDOWN_HOURS} hours).",
                 parse_mode="Markdown"
@@ -643,12 +918,12 @@ async def listcooldowns_command(update: Update, context: ContextTypes.DEFAULT_TY
     if not is_allowed_group(message.chat_id):
         return
     
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
+    if not await is_admin(context, message.chat_id, message.from_user.id):
         await message.reply_text("❌ This command is for group admins only.")
         return
     
-    chat_id = str(message.chat_id)
-    user_cooldowns = load_user_cooldowns()
+    chat_id = message.chat_id
+    user_cooldowns = context.bot_data["user_cooldowns"]
     chat_cooldowns = user_cooldowns.get(chat_id, {})
     
     if not chat_cooldowns:
@@ -676,7 +951,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Check if user is admin in the group
-    if not await is_admin(context.bot, message.chat_id, message.from_user.id):
+    if not await is_admin(context, message.chat_id, message.from_user.id):
         await message.reply_text("❌ This command is for group admins only.")
         return
     
@@ -687,7 +962,6 @@ This bot limits users to 1 message per {MESSAGE_COOLDOWN_HOURS} hours in the mon
 
 **Commands (Admin Only):**
 • `/status` - View current message records
-• `/check_duplicates` - Check for duplicate users today
 • `/reset <user_id>` - Reset a user's message record
 • `/help` - Show this message
 
@@ -715,6 +989,34 @@ _Tip: Set cooldown to 0 for unlimited messages (Green Card)._
 """
     await update.message.reply_text(help_text, parse_mode="Markdown")
 
+async def post_init(application: Application):
+    """Load state and start background tasks once the application is initialized."""
+    bot_data = application.bot_data
+    await init_bot_data(bot_data)
+    logger.info(f"Loaded {len(bot_data['records'])} message records")
+    prune_expired_records(bot_data)
+    
+    bot_data["background_tasks"] += [
+        asyncio.create_task(_flush_loop(bot_data)),
+        asyncio.create_task(_cleanup_records_loop(bot_data)),
+        asyncio.create_task(_sweep_caches_loop(bot_data)),
+        asyncio.create_task(_deletion_loop(application.bot, bot_data)),
+    ]
+
+async def post_shutdown(application: Application):
+    """Stop background tasks and write any pending changes to disk."""
+    bot_data = application.bot_data
+    background_tasks = bot_data["background_tasks"]
+    for task in background_tasks:
+        task.cancel()
+    # Wait for the loops to exit, including a flush that is mid-write
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if any(bot_data["dirty"].values()):
+        await flush_state(bot_data)
+        logger.info("Flushed pending changes to disk")
+    await asyncio.to_thread(close_db)
+
 def main():
     """Start the bot."""
     # Validate required configuration
@@ -728,22 +1030,38 @@ def main():
         logger.error("Please set TOPIC_ID in your .env file")
         return
     
+    if USE_WEBHOOK and not WEBHOOK_URL:
+        logger.error("USE_WEBHOOK is enabled but WEBHOOK_URL is not set!")
+        logger.error("Please set WEBHOOK_URL to the bot's public base URL in your .env file")
+        return
+    
+    # run_webhook needs tornado, which only comes with the optional webhooks extra
+    if USE_WEBHOOK and importlib.util.find_spec("tornado") is None:
+        logger.error("USE_WEBHOOK is enabled but webhook support is not installed!")
+        logger.error('Please run: pip install "python-telegram-bot[webhooks]", or unset USE_WEBHOOK to use polling')
+        return
+    
     logger.info("Starting Topic Message Limiter Bot...")
     logger.info(f"Monitoring Topic ID: {TOPIC_ID}")
     logger.info(f"Message cooldown: {MESSAGE_COOLDOWN_HOURS} hours")
     logger.info(f"Warning delete delay: {WARNING_DELETE_SECONDS} seconds")
     logger.info(f"Admin cache TTL: {ADMIN_CACHE_TTL} seconds")
     if ALLOWED_GROUPS:
-        logger.info(f"Allowed groups: {ALLOWED_GROUPS}")
+        logger.info(f"Allowed groups: {sorted(ALLOWED_GROUPS)}")
     else:
         logger.info("Allowed groups: ALL (no restriction)")
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("status", status_command))
-    application.add_handler(CommandHandler("check_duplicates", check_duplicates_command))
     application.add_handler(CommandHandler("reset", reset_command))
     application.add_handler(CommandHandler("addadmin", addadmin_command))
     application.add_handler(CommandHandler("removeadmin", removeadmin_command))
@@ -752,11 +1070,22 @@ def main():
     application.add_handler(CommandHandler("resetcooldown", resetcooldown_command))
     application.add_handler(CommandHandler("listcooldowns", listcooldowns_command))
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(build_message_filter(), handle_message))
     
     # Start the bot
     logger.info("Bot is running! Press Ctrl+C to stop.")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if USE_WEBHOOK:
+        # The token as the path keeps the endpoint unguessable
+        logger.info(f"Receiving updates via webhook on port {PORT}")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()